@@ -1,24 +1,32 @@
 # Standard library imports
+import functools
+import hashlib
+import json
 import os
+import re
 import sys
-from datetime import timedelta
+import threading
+from pathlib import Path
 
 # Third party imports
 from PyQt6.QtWidgets import QApplication, QPushButton, QVBoxLayout, QWidget, QLineEdit, QMessageBox, QHBoxLayout, \
-    QLabel, QTextEdit
+    QLabel, QPlainTextEdit, QComboBox
 from PyQt6.QtGui import QPalette, QColor, QTextOption
-from PyQt6.QtCore import Qt, QTimer, QThread, pyqtSignal
+from PyQt6.QtCore import Qt, QTimer, QObject, QRunnable, QThreadPool, pyqtSignal
 
 # Local imports
-import whisper
+import ctranslate2
+import numpy as np
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 
 
 # Function definitions
-def format_timestamp(seconds: float, always_include_hours: bool = False, decimal_marker: str = '.'):
+@functools.lru_cache(maxsize=4096)
+def format_timestamp(seconds: float, always_include_hours: bool = False, decimal_marker: str = '.',
+                     include_ms: bool = True):
     """ Converts seconds into a string timestamp. """
     assert seconds >= 0, "Non-negative timestamp expected"
-    time_delta = timedelta(seconds=seconds)
-    total_milliseconds = int(time_delta.total_seconds() * 1000)
+    total_milliseconds = int(seconds * 1000)
     milliseconds = total_milliseconds % 1000
 
     hours, remainder = divmod(total_milliseconds, 3600000)
@@ -26,9 +34,28 @@ def format_timestamp(seconds: float, always_include_hours: bool = False, decimal
     seconds //= 1000  # Convert milliseconds to seconds
 
     hours_marker = f"{hours:02d}:" if always_include_hours or hours > 0 else ""
+    if not include_ms:
+        return f"{hours_marker}{minutes:02d}:{seconds:02d}"
     return f"{hours_marker}{minutes:02d}:{seconds:02d}{decimal_marker}{milliseconds:03d}"
 
 
+def max_workers():
+    """ Returns how many transcriptions can run at the same time on this machine. """
+    cuda_devices = ctranslate2.get_cuda_device_count()
+    if cuda_devices > 0:
+        return cuda_devices
+    # Each CTranslate2 worker already uses 4 CPU threads
+    return max(1, (os.cpu_count() or 1) // 4)
+
+
+def transcript_cache_path(file_path, model_name):
+    """ Returns the cache file of a transcript, keyed by the model and the size and first 4 MiB of the audio. """
+    digest = hashlib.blake2b(f"{model_name}:{os.path.getsize(file_path)}".encode())
+    with open(file_path, "rb") as audio_file:
+        digest.update(audio_file.read(4 << 20))
+    return os.path.join(os.path.expanduser("~"), ".cache", "wordfinder", f"{digest.hexdigest()}.json")
+
+
 class FileEdit(QLineEdit):
     def __init__(self):
         super().__init__()
@@ -67,56 +94,166 @@ class FileEdit(QLineEdit):
 
 
 # Class definitions
-class Worker(QThread):
-    """ Thread worker to process audio and emit progress. """
+class WorkerSignals(QObject):
+    """ Signals emitted by a Worker, QRunnable is not a QObject and cannot define its own. """
     progress = pyqtSignal(str)
+    percent = pyqtSignal(int)
+    loaded = pyqtSignal(str)
+
+
+class Worker(QRunnable):
+    """ Thread pool worker to process audio and emit progress. """
+
+    # English-only tiers, faster and more accurate than the multilingual ones for English audio
+    MODELS = ("tiny.en", "base.en", "small.en", "distil-small.en")
+    DEFAULT_MODEL = "base.en"
 
-    def __init__(self, input_text, wordsList):
+    # The Whisper models are shared across all workers so each is only loaded once while it is in use
+    _models = {}
+    # Each model loads under its own lock so a search never waits on another tier loading
+    _model_locks = {}
+    _model_locks_lock = threading.Lock()
+
+    def __init__(self, input_text, out_file, wordsList, model_name=DEFAULT_MODEL):
         super().__init__()
+        self.signals = WorkerSignals()
         self.input_text = input_text
+        self.out_file = out_file
         self.wordsList = wordsList
+        self.model_name = model_name
+
+        # Lower and deduplicate the words once, the list does not change for the lifetime of the worker
+        self._lowered = tuple(dict.fromkeys(word.lower() for word in wordsList))
+
+        # Compile the words into one case-insensitive pattern so each segment is scanned in a single pass
+        self._pattern = None
+        if self._lowered:
+            self._pattern = re.compile("|".join(re.escape(word) for word in self._lowered), re.IGNORECASE)
 
     def run(self):
         """ Main execution method for the thread. """
-        base_name = os.path.basename(self.input_text)
-        name, ext = os.path.splitext(base_name)
-        out_file = os.path.join(os.path.dirname(self.input_text), f"{name}.txt")
-
+        # Matching segments are streamed into a temporary file that only replaces the result on success
+        temp_file = f"{self.out_file}.{threading.get_ident()}.tmp"
         try:
-            segments = self.process_audio(self.input_text)
-            self.write_file(out_file, segments)
-            self.progress.emit(out_file)
+            with open(temp_file, "w") as output_file:
+                self.process_audio(self.input_text, output_file)
+            os.replace(temp_file, self.out_file)
+            self.signals.progress.emit(self.out_file)
         except Exception as e:
-            self.progress.emit('Error: ' + str(e))
+            # Only this run's temporary file is removed, a previous result is left untouched
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+            self.signals.progress.emit('Error: ' + str(e))
+
+    @classmethod
+    def load_model(cls, model_name=DEFAULT_MODEL):
+        """ Loads the Whisper model on first use and returns the cached batched pipeline afterwards. """
+        pipeline = cls._models.get(model_name)
+        if pipeline is not None:
+            return pipeline
+
+        with cls._model_locks_lock:
+            model_lock = cls._model_locks.setdefault(model_name, threading.Lock())
+
+        with model_lock:
+            pipeline = cls._models.get(model_name)
+            if pipeline is None:
+                # Run on the GPU in half precision when CUDA is available, int8 on the CPU otherwise
+                # One model worker per pool thread lets queued files be transcribed in parallel,
+                # on CUDA the workers are applied per device so one per GPU already matches the pool
+                cuda_devices = ctranslate2.get_cuda_device_count()
+                if cuda_devices > 0:
+                    model = WhisperModel(model_name, device="cuda", device_index=list(range(cuda_devices)),
+                                         compute_type="float16", num_workers=1)
+                else:
+                    model = WhisperModel(model_name, device="cpu", compute_type="int8", num_workers=max_workers())
+                # Warm up on a second of silence so one-time initialization isn't paid by the first search,
+                # greedy decoding without timestamps keeps this cheap, only one model worker is warmed
+                list(model.transcribe(np.zeros(16000, dtype=np.float32), language="en", beam_size=1,
+                                      temperature=0.0, without_timestamps=True)[0])
+                # The pipeline splits the audio on silence and transcribes the chunks as one batch
+                pipeline = BatchedInferencePipeline(model)
+                cls._models[model_name] = pipeline
+            return pipeline
+
+    @classmethod
+    def release_models(cls, keep):
+        """ Drops the cached models not named in keep, searches still running hold on to their own. """
+        for model_name in list(cls._models):
+            if model_name not in keep:
+                cls._models.pop(model_name, None)
+
+    def transcribe(self, file_path):
+        """ Yields (start, text) pairs of the audio, reusing the cached transcript of a previous run. """
+        cache_path = transcript_cache_path(file_path, self.model_name)
+        try:
+            with open(cache_path, encoding="utf-8") as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            # A missing or unreadable entry is transcribed again, which overwrites it
+            cached = None
+        if cached is not None:
+            yield from cached
+            self.signals.percent.emit(100)
+            return
 
-    def process_audio(self, file_path):
-        """ Processes audio and extracts segments containing specific words. """
-        model = whisper.load_model("base")
-        input = model.transcribe(file_path, language="en", fp16=False, verbose=True)
-        # Setting verbose = True adds the real-time transcript. Setting it to false adds the progress bar.
+        model = self.load_model(self.model_name)
+        # The transcription is lazy, segments are decoded as the generator is consumed
+        # Timestamps are kept so each chunk is split back into sentence-level segments,
+        # the pipeline offsets them to the start of the file
+        transcript, info = model.transcribe(file_path, language="en", batch_size=16, without_timestamps=False)
         segments = []
 
-        for segment in input["segments"]:
-            segment["start"] = format_timestamp(segment['start'])
-            segment["start"] = segment["start"].replace('[', '').replace(']', '').replace('.', '').replace(' --> ', ' - ')
-            segment["start"] = segment["start"][0:5]
-
-            # Convert the text to lower case for case-insensitive comparison
-            segment_text_lower = segment['text'].lower()
+        for segment in transcript:
+            segments.append((segment.start, segment.text))
+            yield segment.start, segment.text
+            if info.duration:
+                self.signals.percent.emit(min(100, int(segment.end * 100 / info.duration)))
 
+        # Write to a temporary file first so a concurrent run never reads a partial transcript
+        temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(temp_path, "w", encoding="utf-8") as cache_file:
+                json.dump(segments, cache_file)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # The cache is only an optimization, a failed write must not fail the search
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def process_audio(self, file_path, output_file):
+        """ Processes audio and writes the segments containing specific words to the output file. """
+        for start, text in self.transcribe(file_path):
             # Check if any word in words list is in segment's text
-            if any(word.lower() in segment_text_lower for word in self.wordsList):
-                # Add to list
-                segments.append(f"{segment['start']} - {segment['text']}\n\n")
+            if self.contains_word(text):
+                output_file.write(f"{format_timestamp(start, include_ms=False)} - {text}\n\n")
+
+    def contains_word(self, text):
+        """ Checks case-insensitively whether text contains any of the words. """
+        return self._pattern is not None and self._pattern.search(text) is not None
 
-        return segments
 
-    @staticmethod
-    def write_file(file_path, segments):
-        """ Writes segments to a file. """
-        with open(file_path, "w") as output_file:
-            for segment in segments:
-                output_file.write(segment)
+class ModelLoader(QRunnable):
+    """ Thread pool task to load the Whisper model before the first search. """
+
+    def __init__(self, model_name):
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.model_name = model_name
+
+    def run(self):
+        """ Main execution method for the thread. """
+        try:
+            Worker.load_model(self.model_name)
+        except Exception:
+            # The first search loads the model again and reports the error
+            pass
+        self.signals.loaded.emit(self.model_name)
 
 
 class AppDemo(QWidget):
@@ -144,12 +281,18 @@ class AppDemo(QWidget):
 
         self.wordsList = []  # List to store the words
 
-        # Change QLineEdit to QTextEdit for word input
-        self.wordsInput = QTextEdit()
+        # Plain text is enough for the word input and avoids rich text handling on every keystroke
+        self.wordsInput = QPlainTextEdit()
         self.wordsInput.setPlaceholderText("Example:\nhello, there, general, kenobi")
         self.wordsInput.setMaximumHeight(58)
         self.wordsInput.setMaximumWidth(100)
-        self.wordsInput.textChanged.connect(self.updateWordsList)  # Connect to the textChanged signal
+
+        # Debounce the words list update so it only runs once typing pauses
+        self.wordsTimer = QTimer(self)
+        self.wordsTimer.setSingleShot(True)
+        self.wordsTimer.setInterval(200)
+        self.wordsTimer.timeout.connect(self.updateWordsList)
+        self.wordsInput.textChanged.connect(self.wordsTimer.start)  # Restart the timer on every change
 
 
         # Modify the layout to include new widgets
@@ -163,14 +306,54 @@ class AppDemo(QWidget):
         buttonLayout.addWidget(self.btn2)
         buttonLayout.addStretch()
 
+        # Whisper model tier used for new searches
+        self.modelInput = QComboBox()
+        self.modelInput.addItems(Worker.MODELS)
+        self.modelInput.setCurrentText(Worker.DEFAULT_MODEL)
+        self.modelInput.setMaximumWidth(100)
+        self.modelInput.currentTextChanged.connect(self.preloadModel)
+
+        modelLayout = QHBoxLayout()
+        modelLayout.addStretch()
+        modelLayout.addWidget(self.modelInput)
+        modelLayout.addStretch()
+
         mainLayout.addLayout(hLayout)
+        mainLayout.addLayout(modelLayout)
         mainLayout.addLayout(buttonLayout)  # Add the button layout to the main layout
 
         self.setLayout(mainLayout)
-        self.setFixedSize(150, 200)
+        self.setFixedSize(150, 230)
 
         self.mpos = None
 
+        # Files are transcribed on the global thread pool, several can be queued at once
+        self.pool = QThreadPool.globalInstance()
+        self.pool.setMaxThreadCount(max_workers())
+        self.pending = 0
+        self.percents = {}  # Progress of each file queued since the app was last idle, keyed by its worker's signals
+        self.searchModels = {}  # Model of each running search, keyed by its worker's signals
+
+        # Models load on their own pool so a selection change never waits behind queued searches
+        self.loaderPool = QThreadPool(self)
+
+        # Load the model in the background so the first search doesn't wait for it
+        self.preloadModel(self.modelInput.currentText())
+
+    def preloadModel(self, model_name):
+        self.releaseModels()
+
+        # Disable the button while the selected model is loading
+        self.btn2.setEnabled(False)
+        self.updateButton()
+        loader = ModelLoader(model_name)
+        loader.signals.loaded.connect(self.on_loaded)
+        self.loaderPool.start(loader)
+
+    def releaseModels(self):
+        # Only the selected model and those of running searches are kept in memory
+        Worker.release_models({self.modelInput.currentText(), *self.searchModels.values()})
+
     def mousePressEvent(self, event):
         self.mpos = event.globalPosition()
 
@@ -190,7 +373,25 @@ class AppDemo(QWidget):
         self.wordsList = [word.strip() for word in text.split(',') if word.strip()]
 
 
+    def on_loaded(self, model_name):
+        # Enable the button once the selected model is ready, earlier selections finishing are dropped
+        if model_name != self.modelInput.currentText():
+            self.releaseModels()
+            return
+
+        self.btn2.setEnabled(True)
+        self.updateButton()
+
     def execute(self):
+        # Searches are only started once the model is loaded
+        if not self.btn2.isEnabled():
+            return
+
+        # Apply the last edit to the words list if it is still waiting on the debounce timer
+        if self.wordsTimer.isActive():
+            self.wordsTimer.stop()
+            self.updateWordsList()
+
         # In the execute method, you will need to process self.wordsList
         input_text = self.edit1.text()
 
@@ -198,35 +399,74 @@ class AppDemo(QWidget):
             QMessageBox.critical(self, "Error", "File not found!")
             return
 
-        # Pass the words list to the Worker thread
-        self.worker = Worker(input_text, self.wordsList)  # Assuming you modify Worker to accept the words list
-        self.worker.progress.connect(self.on_progress)
-        self.worker.start()
-
-        # Disable the input field and button while processing
-        self.edit1.setEnabled(False)
-        self.btn2.setEnabled(False)
-        # Change the text on the button to "Searching"
-        self.btn2.setText("Searching...")
+        # The result is written next to the video with a .txt extension
+        out_file = str(Path(input_text).with_suffix(".txt"))
+
+        # Pass the words list to the Worker and queue it on the thread pool
+        worker = Worker(input_text, out_file, self.wordsList, self.modelInput.currentText())
+        worker.signals.progress.connect(self.on_progress)
+        worker.signals.percent.connect(self.on_percent)
+        self.pool.start(worker)
+        self.pending += 1
+        self.percents[worker.signals] = 0
+        self.searchModels[worker.signals] = worker.model_name
+
+        # Clear the input field so another file can be queued while this one is processed
+        self.edit1.setText('')
+        # Change the text on the button to "Searching", or keep showing the progress of the files already queued
+        if self.pending > 1:
+            self.showProgress()
+        else:
+            self.btn2.setText("Searching...")
         self.btn2.setMaximumSize(64, 25)  # Set the maximum size of the button
         self.btn2.setStyleSheet("background-color: #323232; color: white; border: 0px;")
         # Change the border color of the QLineEdit to red
         self.edit1.setStyleSheet("border: 1px solid red;")
 
+    def on_percent(self, percent):
+        self.percents[self.sender()] = percent
+        self.showProgress()
+
+    def showProgress(self):
+        # Show the combined progress of every queued file on the button
+        self.btn2.setText(f"{sum(self.percents.values()) // len(self.percents)}%")
+
+    def updateButton(self):
+        # Running searches show their progress, otherwise the button shows whether the model is ready
+        if self.pending:
+            self.showProgress()
+            return
+
+        self.btn2.setStyleSheet("color: black")
+        if self.btn2.isEnabled():
+            self.btn2.setText("Find")
+            self.btn2.setMaximumSize(50, 25)  # Set the maximum size of the button
+        else:
+            self.btn2.setText("Loading...")
+            self.btn2.setMaximumSize(64, 25)
+
     def on_progress(self, message):
+        # Update the bookkeeping first, the message box below runs its own event loop
+        self.pending -= 1
+        self.searchModels.pop(self.sender(), None)
+        self.releaseModels()
+        if self.pending:
+            self.percents[self.sender()] = 100
+            self.showProgress()
+        else:
+            self.percents.clear()
+
         if message.startswith('Error: '):
             QMessageBox.critical(self, "Error", message[6:])
         else:
-            self.edit1.setText('')
             os.startfile(message)
 
-        # Enable the input field and button after processing
-        self.edit1.setEnabled(True)
-        self.btn2.setEnabled(True)
-        # Change the text on the button back to "Transcribe"
-        self.btn2.setText("Find")
-        self.btn2.setMaximumSize(50, 25)  # Set the maximum size of the button
-        self.btn2.setStyleSheet("color: black")
+        # Keep the searching state until every queued file is processed
+        if self.pending:
+            return
+
+        # Change the button back to "Find", or "Loading..." while a newly selected model loads
+        self.updateButton()
         # Change the border color of the QLineEdit back to the default
         self.edit1.setStyleSheet("")
 